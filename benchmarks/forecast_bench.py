@@ -0,0 +1,90 @@
+"""
+Микробенчмарк прогноза: прежний разбор JSON-словарей на каждое нажатие против ForecastSeries.
+
+Однопроходная сводка по колонкам array по скорости не лучше прежнего цикла по словарям
+(~45 мкс против ~47 мкс на 40 точек), а вместе с разбором ответа вдвое медленнее. Весь выигрыш
+даёт ForecastStore: ряд разбирается и сводится один раз на ответ кэша, а повторные нажатия
+(«завтра», «3 дня», «неделя», другие пользователи того же города) берут готовые сводки — ~2 мкс.
+Колонки компактны (~2 КБ против ~26 КБ у словарей ответа), но сам ответ всё равно живёт
+в кэше запросов, так что заметной экономии памяти они тоже не дают.
+
+    python benchmarks/forecast_bench.py --number 2000
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from forecast_store import ForecastSeries, ForecastStore  # noqa: E402
+
+CONDITIONS = [(800, "clear sky", "01d"), (801, "few clouds", "02d"), (500, "light rain", "10d"), (804, "overcast clouds", "04n")]
+
+
+def make_response(points=40, utc_offset=18000):
+    """ Ответ эндпоинта forecast: 5 дней с шагом 3 часа """
+    start = int(datetime.now(timezone.utc).timestamp()) // 10800 * 10800
+    entries = []
+    for i in range(points):
+        condition_id, description, icon = random.choice(CONDITIONS)
+        entries.append({
+            "dt": start + i * 10800,
+            "main": {"temp": random.uniform(-5, 30), "humidity": random.randint(20, 100)},
+            "wind": {"speed": random.uniform(0, 12)},
+            "weather": [{"id": condition_id, "description": description, "icon": icon}],
+        })
+    return {"cod": "200", "list": entries, "city": {"timezone": utc_offset}}
+
+
+def legacy_tomorrow(data):
+    """ Прежний forecast_weather: фильтр по дате UTC и средние по словарям """
+    tomorrow = datetime.now(timezone.utc) + timedelta(days=1)
+    next_day_data = [entry for entry in data["list"] if datetime.fromtimestamp(entry["dt"], timezone.utc).date() == tomorrow.date()]
+    avg_temp = sum(entry["main"]["temp"] for entry in next_day_data) / len(next_day_data)
+    descriptions = {entry["weather"][0]["description"] for entry in next_day_data}
+    return avg_temp, ", ".join(descriptions).capitalize(), next_day_data[0]["weather"][0]["icon"]
+
+
+def legacy_days(data, days):
+    """ Прежний подход, расширенный на несколько дней: отдельный проход по словарям на каждый день """
+    today = datetime.now(timezone.utc).date()
+    return [legacy_tomorrow_for(data, today + timedelta(days=offset)) for offset in range(1, days + 1)]
+
+
+def legacy_tomorrow_for(data, date):
+    entries = [entry for entry in data["list"] if datetime.fromtimestamp(entry["dt"], timezone.utc).date() == date]
+    if not entries:
+        return None
+    temps = [entry["main"]["temp"] for entry in entries]
+    return min(temps), max(temps), sum(temps) / len(temps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    data = make_response()
+    store = ForecastStore(16)
+    store.get("tashkent", data).daily()
+    series = ForecastSeries.from_response(data)
+    tomorrow = series.local_day(int(datetime.now(timezone.utc).timestamp())) + 1
+
+    cases = [
+        ("legacy: завтра (dict)", lambda: legacy_tomorrow(data)),
+        ("legacy: 3 дня (dict)", lambda: legacy_days(data, 3)),
+        ("series: разбор + сводка", lambda: ForecastSeries.from_response(data).aggregate()),
+        ("series: сводка по ряду", lambda: series.aggregate()),
+        # Единственный случай, который быстрее прежнего кода: повторное использование разобранного ряда
+        ("store: повторное нажатие", lambda: store.get("tashkent", data).days_from(tomorrow, 3)),
+    ]
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=args.number)
+        print(f"{name:<28} {elapsed / args.number * 1e6:9.2f} мкс/вызов")
+
+
+if __name__ == "__main__":
+    main()
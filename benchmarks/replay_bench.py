@@ -0,0 +1,123 @@
+"""
+Воспроизведение записанных обновлений через обработчики forecast.py на заглушках.
+
+Поднимает локальные заглушки Bot API, OpenWeatherMap и PostgreSQL (простой протокол
+запросов, которого достаточно psycopg2), импортирует forecast.py с окружением, указывающим
+на них, и прогоняет обновления из updates.jsonl через пул потоков telebot. Каждое обновление
+идёт от своего chat_id: так видна сквозная задержка каждого из них, а кэш погоды общий, как в проде.
+
+    python benchmarks/replay_bench.py --repeat 200 --threads 8 --latency 0.05 --max-p99-ms 500
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.stubs import start_http_stub, start_pg_stub, stub_environment  # noqa: E402
+
+UPDATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "updates.jsonl")
+
+
+def load_updates(path, repeat):
+    """ Записанная сессия repeat раз, у каждого обновления свой chat_id """
+    with open(path, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    updates = []
+    for _ in range(repeat):
+        for template in recorded:
+            update = copy.deepcopy(template)
+            update["update_id"] = len(updates) + 1
+            chat_id = 1_000_000 + update["update_id"]
+            body = update.get("message") or update["callback_query"]
+            body["from"]["id"] = chat_id
+            message = update.get("message") or update["callback_query"]["message"]
+            message["chat"]["id"] = chat_id
+            updates.append(update)
+    return updates
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", default=UPDATES_PATH, help="файл с записанными обновлениями (JSON Lines)")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8, help="размер пула потоков telebot")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка заглушек HTTP, с")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="задержка заглушки PostgreSQL, с")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько ждать обработки всех обновлений, с")
+    parser.add_argument("--max-p99-ms", type=float, help="завершиться с ошибкой, если p99 выше порога")
+    args = parser.parse_args()
+
+    http_server, calls = start_http_stub(args.latency)
+    pg_server = start_pg_stub(args.db_latency)
+    os.environ.update(stub_environment(http_server, pg_server))
+    import telebot
+    import forecast
+
+    forecast.bot.worker_pool = telebot.util.ThreadPool(forecast.bot, num_threads=args.threads)
+
+    # Сквозная задержка: от постановки обновления в очередь до конца обработчика
+    enqueued = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(func):
+        def wrapper(update):
+            try:
+                return func(update)
+            finally:
+                message = update.message if isinstance(update, telebot.types.CallbackQuery) else update
+                chat_id = message.chat.id
+                with lock:
+                    latencies.append(time.monotonic() - enqueued[chat_id])
+        return wrapper
+
+    for handler in forecast.bot.message_handlers + forecast.bot.callback_query_handlers:
+        handler["function"] = timed(handler["function"])
+
+    updates = load_updates(args.updates, args.repeat)
+    started = time.monotonic()
+    for update in updates:
+        parsed = telebot.types.Update.de_json(update)
+        body = parsed.message or parsed.callback_query.message
+        with lock:
+            enqueued[body.chat.id] = time.monotonic()
+        forecast.bot.process_new_updates([parsed])
+
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        with lock:
+            done = len(latencies)
+        if done >= len(updates):
+            break
+        time.sleep(0.01)
+    else:
+        print(f"обработано {done} из {len(updates)} обновлений за {args.timeout}s")
+    elapsed = time.monotonic() - started
+    forecast.close_writers()
+
+    p99 = percentile(latencies, 0.99) * 1000
+    print(f"{len(updates)} обновлений за {elapsed:.2f}s: {len(updates) / elapsed:.1f} обн./с, "
+          f"p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p99 {p99:.1f} мс")
+    for name, histogram in sorted(forecast.handler_latency.items()):
+        print(f"  {name:<28} {histogram.count:>6} вызовов, p99 ≤ {histogram.quantile(0.99) * 1000:.0f} мс")
+    print("  запросы к заглушкам: " + ", ".join(f"{name} {count}" for name, count in sorted(calls.items())))
+    print("  кэш погоды: " + ", ".join(f"{key} {value}" for key, value in forecast.weather_cache.stats().items()))
+
+    if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+        print(f"p99 {p99:.1f} мс превышает порог {args.max_p99_ms} мс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
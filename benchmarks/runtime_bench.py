@@ -0,0 +1,162 @@
+"""
+Нагрузочный тест обработчиков forecast.py: синхронный бот (forecast.bot, пул потоков telebot)
+против асинхронного (create_async_bot(), AsyncTeleBot + aiohttp).
+
+Оба режима получают одни и те же записанные обновления из updates.jsonl и ходят в одни и те же
+заглушки Bot API, OpenWeatherMap и PostgreSQL из tests/stubs.py. Одновременно обрабатывается
+не больше --concurrency обновлений: это размер пула потоков в синхронном режиме и число
+одновременных process_new_updates в асинхронном. Перед каждым режимом кэш погоды и file_id
+иконок сбрасываются, поэтому число запросов к заглушкам в обоих режимах совпадает.
+
+    python benchmarks/runtime_bench.py --repeat 100 --latency 0.05 --concurrency 8
+"""
+import argparse
+import asyncio
+import functools
+import os
+import threading
+import time
+
+import telebot
+
+from replay_bench import UPDATES_PATH, load_updates, percentile
+from tests.stubs import start_http_stub, start_pg_stub, stub_environment
+
+
+def chat_id_of(update):
+    """ chat_id сообщения или сообщения под кнопкой """
+    message = update.message if isinstance(update, telebot.types.CallbackQuery) else update
+    return message.chat.id
+
+
+def reset_state(forecast):
+    """ Холодный старт: пустой кэш погоды и неизвестные file_id иконок """
+    with forecast.weather_cache.lock:
+        forecast.weather_cache.entries.clear()
+        forecast.weather_cache.hits = forecast.weather_cache.misses = 0
+    with forecast.weather_icons.lock:
+        forecast.weather_icons.file_ids.clear()
+
+
+def run_threaded(forecast, updates, concurrency, timeout):
+    bot = forecast.bot
+    bot.worker_pool = telebot.util.ThreadPool(bot, num_threads=concurrency)
+    enqueued, latencies = {}, []
+    lock = threading.Lock()
+
+    def timed(func):
+        def wrapper(update):
+            try:
+                return func(update)
+            finally:
+                with lock:
+                    latencies.append(time.monotonic() - enqueued[chat_id_of(update)])
+        return wrapper
+
+    handlers = bot.message_handlers + bot.callback_query_handlers
+    originals = [handler["function"] for handler in handlers]
+    for handler in handlers:
+        handler["function"] = timed(handler["function"])
+
+    try:
+        started = time.monotonic()
+        for update in updates:
+            with lock:
+                enqueued[chat_id_of(update.message or update.callback_query)] = time.monotonic()
+            bot.process_new_updates([update])
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with lock:
+                if len(latencies) >= len(updates):
+                    break
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started
+    finally:
+        for handler, function in zip(handlers, originals):
+            handler["function"] = function
+        bot.worker_pool.close()
+    return elapsed, latencies
+
+
+async def run_async(forecast, updates, concurrency):
+    async_bot = forecast.create_async_bot()
+    enqueued, latencies = {}, []
+
+    def timed(func):
+        # AsyncTeleBot выбирает аргументы обработчика по сигнатуре, поэтому wraps обязателен
+        @functools.wraps(func)
+        async def wrapper(update):
+            try:
+                return await func(update)
+            finally:
+                latencies.append(time.monotonic() - enqueued[chat_id_of(update)])
+        return wrapper
+
+    for handler in async_bot.message_handlers + async_bot.callback_query_handlers:
+        handler["function"] = timed(handler["function"])
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(update):
+        async with semaphore:
+            await async_bot.process_new_updates([update])
+
+    try:
+        started = time.monotonic()
+        for update in updates:
+            enqueued[chat_id_of(update.message or update.callback_query)] = started
+        await asyncio.gather(*(feed(update) for update in updates))
+        return time.monotonic() - started, latencies
+    finally:
+        await async_bot.close_session()
+        if forecast.aio_session is not None:
+            await forecast.aio_session.close()
+
+
+def report(name, total, elapsed, latencies, calls):
+    print(
+        f"{name:<9} {len(latencies):>5}/{total} обновлений за {elapsed:6.2f}s  "
+        f"{len(latencies) / elapsed:7.1f} обн./с  "
+        f"p50 {percentile(latencies, 0.5) * 1000:7.1f} мс  p99 {percentile(latencies, 0.99) * 1000:7.1f} мс"
+    )
+    print("          запросы к заглушкам: " + ", ".join(f"{key} {value}" for key, value in sorted(calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", default=UPDATES_PATH, help="файл с записанными обновлениями (JSON Lines)")
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="потоков у TeleBot и одновременных обновлений у AsyncTeleBot")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка заглушек HTTP, с")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="задержка заглушки PostgreSQL, с")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько ждать синхронный режим, с")
+    args = parser.parse_args()
+
+    http_server, calls = start_http_stub(args.latency)
+    pg_server = start_pg_stub(args.db_latency)
+    os.environ.update(stub_environment(http_server, pg_server))
+    import forecast
+
+    recorded = load_updates(args.updates, args.repeat)
+
+    def parsed():
+        return [telebot.types.Update.de_json(update) for update in recorded]
+
+    try:
+        for name, run in (
+            ("threaded", lambda updates: run_threaded(forecast, updates, args.concurrency, args.timeout)),
+            ("async", lambda updates: asyncio.run(run_async(forecast, updates, args.concurrency))),
+        ):
+            reset_state(forecast)
+            before = dict(calls)
+            elapsed, latencies = run(parsed())
+            report(name, len(recorded), elapsed, latencies, {key: calls[key] - before.get(key, 0) for key in calls})
+    finally:
+        forecast.close_writers()
+        http_server.shutdown()
+        pg_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,37 @@
 import os
+import asyncio
+import atexit
+import random
+import re
+import signal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
 import telebot
 from telebot import types
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
 from dotenv import load_dotenv
+import psycopg2.extensions
 import psycopg2.pool
+from psycopg2.extras import execute_values
 from urllib.parse import urlparse
 import logging
+import bisect
+import functools
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import gettext
 from apscheduler.schedulers.background import BackgroundScheduler
 
+from forecast_store import SECONDS_PER_DAY, ForecastStore
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -30,6 +52,103 @@ if not DATABASE_URL:
 # Парсим DATABASE_URL
 parsed_url = urlparse(DATABASE_URL)
 
+
+class LatencyHistogram:
+    """ Гистограмма задержек с фиксированными границами корзин (в секундах) """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"buckets": self.buckets, "counts": list(self.counts), "sum": self.total, "count": self.count}
+
+    def quantile(self, q):
+        """ Верхняя граница корзины, в которую попадает квантиль q (inf — за последней границей) """
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+        return float("inf")
+
+
+# Метрики: задержки обработчиков, вызовов и Bot API, счётчики ошибок
+handler_latency = defaultdict(LatencyHistogram)
+call_latency = defaultdict(LatencyHistogram)
+telegram_latency = defaultdict(LatencyHistogram)
+error_counts = defaultdict(int)
+in_flight = defaultdict(int)
+metrics_lock = threading.Lock()
+
+
+def count_error(source):
+    with metrics_lock:
+        error_counts[source] += 1
+
+
+def instrumented(name, histograms=handler_latency):
+    """ Декоратор: задержка в histograms[name], ошибки в error_counts, число выполняющихся вызовов """
+
+    def track(delta):
+        with metrics_lock:
+            in_flight[name] += delta
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                track(1)
+                started = time.monotonic()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    count_error(name)
+                    raise
+                finally:
+                    histograms[name].observe(time.monotonic() - started)
+                    track(-1)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                track(1)
+                started = time.monotonic()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    count_error(name)
+                    raise
+                finally:
+                    histograms[name].observe(time.monotonic() - started)
+                    track(-1)
+        return wrapper
+
+    return decorator
+
+
+def instrument_bot(target):
+    """ Оборачивает send_* у TeleBot или AsyncTeleBot для учёта задержек Bot API """
+    for method in ("send_message", "send_photo"):
+        setattr(target, method, instrumented(method, telegram_latency)(getattr(target, method)))
+    return target
+
+
 # Настройка пула соединений с базой данных
 DB_PARAMS = {
     "dbname": parsed_url.path[1:], 
@@ -37,20 +156,98 @@ DB_PARAMS = {
     "password": parsed_url.password,
     "host": parsed_url.hostname,
     "port": parsed_url.port,
-    "sslmode": "require",  # Railway требует SSL
+    "sslmode": os.getenv("DB_SSLMODE", "require"),  # Railway требует SSL
+}
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """ Соединение, помнящее, какие запросы на нём уже подготовлены (PREPARE живёт в сессии) """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """ Потокобезопасный пул: при исчерпании ждёт свободное соединение не дольше timeout """
+
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # minconn открывается сразу, но держать простаивающими можно все maxconn: базовый putconn
+        # закрывает соединения сверх minconn, и под нагрузкой каждый запрос переподключался бы
+        # и заново делал PREPARE
+        self.minconn = maxconn
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_latency = LatencyHistogram(DB_BUCKETS)
+
+    def getconn(self, key=None):
+        started = time.monotonic()
+        if not self.slots.acquire(blocking=False):
+            with self.stats_lock:
+                self.waits += 1
+            if not self.slots.acquire(timeout=self.timeout):
+                with self.stats_lock:
+                    self.timeouts += 1
+                raise psycopg2.pool.PoolError(f"no free connection in pool after {self.timeout}s")
+        self.wait_latency.observe(time.monotonic() - started)
+
+        try:
+            conn = super().getconn(key)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.stats_lock:
+            self.in_use += 1
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "in_use": self.in_use, "max": self.maxconn, "open": len(self._pool) + len(self._used),
+                "waits": self.waits, "timeouts": self.timeouts,
+            }
+
+
+# Пул соединений и метрики БД
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 5))
+DB_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+db_latency = defaultdict(lambda: LatencyHistogram(DB_BUCKETS))
+
+# Фиксированные запросы бота, подготавливаются на каждом соединении при первом вызове
+PREPARED_STATEMENTS = {
+    "users_count": "SELECT COUNT(*) FROM telegram_users",
+    "unsubscribe": "DELETE FROM weather_subscriptions WHERE user_id = ANY($1)",
 }
 
-# Попробуем подключиться, сначала без SSL
 try:
-    conn_pool = psycopg2.pool.SimpleConnectionPool(1, 10, **DB_PARAMS)
+    conn_pool = BlockingConnectionPool(
+        DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, connection_factory=PreparedConnection, **DB_PARAMS
+    )
     logging.info("Connected to PostgreSQL on Railway.")
 except psycopg2.OperationalError as e:
     logging.error(f"Database connection failed: {e}")
     raise
 
 
-# Подключение к боту
-bot = telebot.TeleBot(BOT_TOKEN)
+# Подключение к боту (TELEGRAM_API_URL позволяет направить бота на заглушку Bot API в бенчмарках)
+if os.getenv("TELEGRAM_API_URL"):
+    telebot.apihelper.API_URL = asyncio_helper.API_URL = os.getenv("TELEGRAM_API_URL")
+bot = instrument_bot(telebot.TeleBot(BOT_TOKEN))
 user_selected_city = {}
 
 # Настройка мультиязычности
@@ -59,204 +256,1368 @@ gettext.textdomain("messages")
 _ = gettext.gettext  # Функция перевода
 
 
+@instrumented("execute_query", call_latency)
 def execute_query(query, params=None, fetchone=False, fetchall=False):
     """ Выполнение SQL-запросов с использованием пула соединений """
     conn = conn_pool.getconn()
+    started = time.monotonic()
     try:
+        # Одиночные запросы выполняются в autocommit: без BEGIN/COMMIT, чтениям commit не нужен
+        conn.autocommit = True
         with conn.cursor() as cur:
             cur.execute(query, params)
-            conn.commit()
             if fetchone:
                 return cur.fetchone()
             elif fetchall:
                 return cur.fetchall()
     except Exception as e:
         logging.error(f"Ошибка в БД: {e}")
+        count_error("db")
+        raise
+    finally:
+        db_latency["query"].observe(time.monotonic() - started)
+        conn_pool.putconn(conn)
+
+
+@instrumented("execute_prepared", call_latency)
+def execute_prepared(name, params=(), fetchone=False, fetchall=False):
+    """ Выполнение именованного запроса из PREPARED_STATEMENTS; PREPARE делается один раз на соединение """
+    conn = conn_pool.getconn()
+    started = time.monotonic()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            if name not in conn.prepared:
+                cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+                conn.prepared.add(name)
+            placeholders = ", ".join(["%s"] * len(params))
+            cur.execute(f"EXECUTE {name}({placeholders})" if params else f"EXECUTE {name}", params)
+            if fetchone:
+                return cur.fetchone()
+            elif fetchall:
+                return cur.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка в БД ({name}): {e}")
+        count_error("db")
+        raise
+    finally:
+        db_latency[name].observe(time.monotonic() - started)
+        conn_pool.putconn(conn)
+
+
+def execute_batch(query, rows):
+    """ Многострочный запрос одной командой (VALUES %s раскрывается execute_values) """
+    conn = conn_pool.getconn()
+    started = time.monotonic()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            execute_values(cur, query, rows, page_size=len(rows))
     finally:
+        db_latency["batch"].observe(time.monotonic() - started)
         conn_pool.putconn(conn)
 
 
+# Отложенная запись: размер пакета и интервал сброса
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 1.0))
+# Сколько секунд строка переживает недоступность БД, прежде чем её отбросить
+WRITE_BEHIND_MAX_RETRY_SECONDS = float(os.getenv("WRITE_BEHIND_MAX_RETRY_SECONDS", 300))
+# Потолок паузы между повторами после ошибки (пауза удваивается начиная с interval)
+WRITE_BEHIND_MAX_BACKOFF = 10.0
+# Ошибки соединения и пула: повтор имеет смысл; остальные означают, что плоха сама строка
+TRANSIENT_DB_ERRORS = (psycopg2.OperationalError, psycopg2.pool.PoolError)
+
+
+class WriteBehindQueue:
+    """ Копит записи по ключу (последняя побеждает) и сбрасывает их пакетом по размеру или по таймеру """
+
+    def __init__(self, name, flush_batch, batch_size, interval, max_retry_seconds=WRITE_BEHIND_MAX_RETRY_SECONDS):
+        self.name = name
+        self.flush_batch = flush_batch
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retry_seconds = max_retry_seconds
+        self.pending = {}
+        # Ключ -> время первой неудачной записи текущего значения
+        self.failing_since = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f"write-behind-{name}", daemon=True)
+        self.thread.start()
+
+    def put(self, key, value):
+        with self.condition:
+            self.pending[key] = value
+            self.failing_since.pop(key, None)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def _run(self):
+        retry_delay = 0.0
+        while True:
+            with self.condition:
+                if retry_delay:
+                    # После ошибки ждём паузу целиком: полная очередь не должна крутить повторы вхолостую
+                    deadline = time.monotonic() + retry_delay
+                    while not self.closed and time.monotonic() < deadline:
+                        self.condition.wait(deadline - time.monotonic())
+                elif not self.closed and len(self.pending) < self.batch_size:
+                    self.condition.wait(self.interval)
+                closed = self.closed
+            if self.flush():
+                retry_delay = 0.0
+            else:
+                retry_delay = min(max(retry_delay * 2, self.interval), WRITE_BEHIND_MAX_BACKOFF)
+            if closed:
+                return
+
+    def flush(self):
+        """ Сбрасывает накопленное; False, если часть строк вернулась в очередь для повтора """
+        with self.condition:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return True
+        try:
+            self.flush_batch(batch)
+            failed = {}
+        except TRANSIENT_DB_ERRORS as e:
+            logging.error(f"Ошибка пакетной записи {self.name} ({len(batch)} строк): {e}")
+            failed = batch
+        except Exception as e:
+            logging.error(f"Ошибка пакетной записи {self.name} ({len(batch)} строк), пишем по одной: {e}")
+            failed = self._flush_rows(batch)
+        return not self._requeue(batch, failed)
+
+    def _flush_rows(self, batch):
+        """ Построчная запись: одна плохая строка не должна держать весь пакет """
+        failed = {}
+        for key, value in batch.items():
+            try:
+                self.flush_batch({key: value})
+            except TRANSIENT_DB_ERRORS:
+                failed[key] = value
+            except Exception as e:
+                logging.error(f"Запись {self.name} {key} отброшена: {e}")
+        return failed
+
+    def _requeue(self, batch, failed):
+        """ Возвращает в очередь строки, упавшие из-за БД, пока они ждут меньше max_retry_seconds; число возвращённых """
+        now = time.monotonic()
+        requeued = dropped = 0
+        with self.condition:
+            for key in batch:
+                if key not in failed:
+                    self.failing_since.pop(key, None)
+            for key, value in failed.items():
+                # Более свежее значение уже в очереди и пойдёт со следующим сбросом
+                if key in self.pending:
+                    continue
+                if now - self.failing_since.setdefault(key, now) >= self.max_retry_seconds:
+                    self.failing_since.pop(key)
+                    dropped += 1
+                else:
+                    self.pending[key] = value
+                    requeued += 1
+        if dropped:
+            logging.error(f"{self.name}: отброшено {dropped} строк, БД недоступна дольше {self.max_retry_seconds:.0f} с")
+        return requeued
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+SAVE_USERS_QUERY = """
+    INSERT INTO telegram_users (telegram_id, username, first_name, last_name, language_code, is_premium)
+    VALUES %s
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        language_code = EXCLUDED.language_code,
+        is_premium = EXCLUDED.is_premium;
+"""
+# Смена города сбрасывает расписание: планировщик пересчитает его по часовому поясу нового города
+SUBSCRIBE_QUERY = (
+    "INSERT INTO weather_subscriptions (user_id, city) VALUES %s "
+    "ON CONFLICT (user_id) DO UPDATE SET city = EXCLUDED.city, next_send_at = NULL;"
+)
+
+
+def flush_users(batch):
+    execute_batch(SAVE_USERS_QUERY, list(batch.values()))
+
+
+def flush_subscriptions(batch):
+    """ city=None означает отписку; для одного пользователя остаётся только последнее действие """
+    upserts = [(user_id, city) for user_id, city in batch.items() if city is not None]
+    deletes = [user_id for user_id, city in batch.items() if city is None]
+    if upserts:
+        execute_batch(SUBSCRIBE_QUERY, upserts)
+    if deletes:
+        execute_prepared("unsubscribe", (deletes,))
+
+
+user_writer = WriteBehindQueue("telegram_users", flush_users, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL)
+subscription_writer = WriteBehindQueue("weather_subscriptions", flush_subscriptions, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL)
+
+
+# Иконки погоды: после первой загрузки Telegram отдаёт file_id, дальше шлём его вместо URL
+ICON_URL = "http://openweathermap.org/img/wn/{}@4x.png"
+ICON_SCHEMA_QUERY = "CREATE TABLE IF NOT EXISTS weather_icons (icon_code TEXT PRIMARY KEY, file_id TEXT NOT NULL);"
+SAVE_ICONS_QUERY = (
+    "INSERT INTO weather_icons (icon_code, file_id) VALUES %s "
+    "ON CONFLICT (icon_code) DO UPDATE SET file_id = EXCLUDED.file_id;"
+)
+
+
+def flush_icons(batch):
+    execute_batch(SAVE_ICONS_QUERY, list(batch.items()))
+
+
+icon_writer = WriteBehindQueue("weather_icons", flush_icons, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL)
+
+
+class IconRegistry:
+    """ Соответствие код иконки -> file_id в Telegram, хранится в таблице weather_icons """
+
+    def __init__(self):
+        self.file_ids = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        execute_query(ICON_SCHEMA_QUERY)
+        rows = execute_query("SELECT icon_code, file_id FROM weather_icons;", fetchall=True)
+        with self.lock:
+            self.file_ids.update(rows)
+        logging.info(f"Загружено file_id иконок: {len(rows)}")
+
+    def photo(self, icon_code):
+        """ file_id, если иконка уже загружалась, иначе URL для первой загрузки """
+        with self.lock:
+            return self.file_ids.get(icon_code) or ICON_URL.format(icon_code)
+
+    def is_cached(self, icon_code):
+        with self.lock:
+            return icon_code in self.file_ids
+
+    def remember(self, icon_code, message):
+        if not message or not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        with self.lock:
+            if self.file_ids.get(icon_code) == file_id:
+                return
+            self.file_ids[icon_code] = file_id
+        icon_writer.put(icon_code, file_id)
+
+    def forget(self, icon_code):
+        with self.lock:
+            self.file_ids.pop(icon_code, None)
+
+
+weather_icons = IconRegistry()
+
+
+def close_writers():
+    """ Сбрасываем накопленные записи при остановке """
+    user_writer.close()
+    subscription_writer.close()
+    icon_writer.close()
+
+
+atexit.register(close_writers)
+
+
 def save_user(user):
-    """ Сохранение пользователя в базу данных """
-    query = """
-        INSERT INTO telegram_users (telegram_id, username, first_name, last_name, language_code, is_premium)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (telegram_id) DO UPDATE 
-        SET username = EXCLUDED.username, 
-            first_name = EXCLUDED.first_name,
-            last_name = EXCLUDED.last_name,
-            language_code = EXCLUDED.language_code,
-            is_premium = EXCLUDED.is_premium;
-    """
+    """ Сохранение пользователя в базу данных (отложенной пакетной записью) """
     params = (user.id, user.username, user.first_name, user.last_name, user.language_code, getattr(user, "is_premium", False))
-    execute_query(query, params)
+    user_writer.put(user.id, params)
 
 
-@bot.message_handler(commands=['start'])
-def start(message):
-    save_user(message.from_user)
-    
+DB_ERROR_TEXT = "❌ База данных временно недоступна, попробуйте позже."
+
+
+def is_admin(chat_id):
+    return chat_id == int(os.getenv("ADMIN_ID", 0))
+
+
+# COUNT(*) по всей таблице не нужен на каждый вызов /users_count и /stats
+USERS_COUNT_TTL = 60
+users_count_cache = {"value": None, "expires": 0.0}
+
+
+def cached_users_count():
+    if time.monotonic() >= users_count_cache["expires"]:
+        users_count_cache["value"] = execute_prepared("users_count", fetchone=True)[0]
+        users_count_cache["expires"] = time.monotonic() + USERS_COUNT_TTL
+    return users_count_cache["value"]
+
+
+@lru_cache(maxsize=None)
+def build_start_markup():
+    """ Клавиатура с кнопками локации и выбора города, сериализуется один раз """
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
     location_button = types.KeyboardButton(_('📍 Отправить локацию'), request_location=True)
     city_button = types.KeyboardButton(_('🏙 Выбрать город'))
-    
+
     markup.add(location_button, city_button)
+    # telebot передаёт строку reply_markup как есть, без повторного to_json()
+    return markup.to_json()
+
 
-    bot.send_message(
-        message.chat.id,
-        _("👋 Привет! Я твой погодный бот!\n\n🌍 Отправь свою **локацию** или выбери **город**, чтобы узнать прогноз погоды."),
-        reply_markup=markup, parse_mode="Markdown"
+@lru_cache(maxsize=1024)
+def build_city_markup(city):
+    """ Кнопки прогноза и подписки для города, уже в виде JSON """
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("📅 Погода на завтра", callback_data=f"forecast_{city}"))
+    markup.row(
+        types.InlineKeyboardButton("🗓 На 3 дня", callback_data=f"forecast3_{city}"),
+        types.InlineKeyboardButton("🗓 На неделю", callback_data=f"forecast7_{city}"),
     )
+    markup.add(types.InlineKeyboardButton("🔔 Получать уведомления", callback_data=f"notify_{city}"))
+    return markup.to_json()
 
-def make_weather_request(endpoint, params):
-    """ Универсальный метод для запросов к OpenWeatherMap """
+
+def start_text():
+    return _("👋 Привет! Я твой погодный бот!\n\n🌍 Отправь свою **локацию** или выбери **город**, чтобы узнать прогноз погоды.")
+
+
+@bot.message_handler(commands=['start'])
+@instrumented("start")
+def start(message):
+    save_user(message.from_user)
+
+    bot.send_message(message.chat.id, start_text(), reply_markup=build_start_markup(), parse_mode="Markdown")
+
+# Кэш ответов OpenWeatherMap: время жизни по эндпоинтам и ограничение размера
+WEATHER_CACHE_TTL = {
+    "weather": int(os.getenv("WEATHER_CACHE_TTL", 300)),
+    "forecast": int(os.getenv("FORECAST_CACHE_TTL", 1800)),
+}
+WEATHER_CACHE_MAX_ENTRIES = int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", 2000))
+COORD_PRECISION = 2  # ~1 км: соседние пользователи делят одну запись
+
+
+class WeatherCache:
+    """ LRU-кэш с TTL и объединением одновременных запросов по одному ключу """
+
+    def __init__(self, ttls, max_entries):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.async_in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(endpoint, params):
+        normalized = []
+        for name, value in params.items():
+            if name in ("lat", "lon"):
+                value = round(float(value), COORD_PRECISION)
+            elif isinstance(value, str):
+                value = " ".join(value.split()).casefold()
+            normalized.append((name, value))
+        return endpoint, tuple(sorted(normalized))
+
+    def _lookup(self, key):
+        """ Свежая запись или None; вызывается под self.lock """
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def _store(self, key, endpoint, data):
+        """ Сохраняем только успешные ответы; вызывается под self.lock """
+        if data and str(data.get("cod")) == "200":
+            self.entries[key] = (time.monotonic() + self.ttls.get(endpoint, 0), data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_fetch(self, endpoint, params, fetch):
+        key = self.make_key(endpoint, params)
+        with self.lock:
+            data = self._lookup(key)
+            if data is not None:
+                return data
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        data = None
+        try:
+            data = fetch(endpoint, params)
+        finally:
+            with self.lock:
+                self._store(key, endpoint, data)
+                del self.in_flight[key]
+            future.set_result(data)
+        return data
+
+    async def get_or_fetch_async(self, endpoint, params, fetch):
+        """ То же для asyncio: ожидающие запросы делят один asyncio.Future """
+        key = self.make_key(endpoint, params)
+        with self.lock:
+            data = self._lookup(key)
+        if data is not None:
+            return data
+
+        future = self.async_in_flight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.async_in_flight[key] = asyncio.get_running_loop().create_future()
+
+        data = None
+        try:
+            data = await fetch(endpoint, params)
+        finally:
+            with self.lock:
+                self._store(key, endpoint, data)
+            del self.async_in_flight[key]
+            future.set_result(data)
+        return data
+
+    def get_stale(self, endpoint, params):
+        """ Последний сохранённый ответ, даже если его TTL истёк """
+        with self.lock:
+            entry = self.entries.get(self.make_key(endpoint, params))
+            return entry[1] if entry else None
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+weather_cache = WeatherCache(WEATHER_CACHE_TTL, WEATHER_CACHE_MAX_ENTRIES)
+
+
+# HTTP-клиент OpenWeatherMap: пул соединений, таймауты, повторы и автомат-предохранитель
+WEATHER_TIMEOUT = (float(os.getenv("WEATHER_CONNECT_TIMEOUT", 3.05)), float(os.getenv("WEATHER_READ_TIMEOUT", 10)))
+WEATHER_RETRIES = int(os.getenv("WEATHER_RETRIES", 3))
+WEATHER_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Retry-After длиннее этого не ждём (поток бота занят всё это время), повторяем по обычной задержке
+WEATHER_MAX_RETRY_AFTER = 5.0
+WEATHER_URL = os.getenv("WEATHER_API_URL", "https://api.openweathermap.org/data/2.5") + "/{}"
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+
+
+class WeatherRetry(Retry):
+    """ Retry с ограничением на Retry-After: длинные значения игнорируются в пользу backoff """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is not None and retry_after > WEATHER_MAX_RETRY_AFTER:
+            return None
+        return retry_after
+
+
+def create_weather_session():
+    """ Общая сессия requests с пулом соединений и повторами на 429/5xx """
+    retry = WeatherRetry(
+        total=WEATHER_RETRIES,
+        # Таймаут чтения не повторяем: зависший сервер ответит так же, а поток ждёт read timeout на каждой попытке
+        read=0,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=WEATHER_RETRY_STATUSES,
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CircuitBreaker:
+    """ Размыкается после серии ошибок и пропускает пробный запрос после паузы """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Полуоткрытое состояние: пропускаем один запрос
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+weather_session = create_weather_session()
+weather_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN)
+weather_latency = defaultdict(LatencyHistogram)
+
+
+def fetch_from_openweathermap(endpoint, params):
+    """ Прямой запрос к OpenWeatherMap без кэша; None, если сервис недоступен """
+    if not weather_breaker.allow():
+        return None
+
+    started = time.monotonic()
     try:
-        url = f"https://api.openweathermap.org/data/2.5/{endpoint}"
-        params["appid"] = API_KEY
-        params["units"] = "metric"
-        response = requests.get(url, params=params)
+        query = {**params, "appid": API_KEY, "units": "metric"}
+        response = weather_session.get(WEATHER_URL.format(endpoint), params=query, timeout=WEATHER_TIMEOUT)
+        if response.status_code >= 500 or response.status_code == 429:
+            raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+        weather_breaker.record(True)
         return response.json()
     except Exception as e:
+        weather_breaker.record(False)
+        count_error("weather_api")
         logging.error(f"Ошибка запроса к OpenWeatherMap: {e}")
         return None
+    finally:
+        weather_latency[endpoint].observe(time.monotonic() - started)
 
 
-def fetch_weather(chat_id, city):
-    data = make_weather_request("weather", {"q": city})
+def round_coordinates(params):
+    if "lat" in params and "lon" in params:
+        return {**params, "lat": round(params["lat"], COORD_PRECISION), "lon": round(params["lon"], COORD_PRECISION)}
+    return params
 
-    if not data or data.get("cod") != 200:
-        bot.send_message(chat_id, f"⚠️ Город **{city}** не найден.")
-        return
 
-    try:
-        temp = round(data["main"]["temp"])
-        description = data["weather"][0]["description"].capitalize()
-        icon_code = data["weather"][0]["icon"]
-        icon_url = f"http://openweathermap.org/img/wn/{icon_code}@4x.png"
+@instrumented("make_weather_request", call_latency)
+def make_weather_request(endpoint, params):
+    """ Универсальный метод для запросов к OpenWeatherMap (через кэш) """
+    params = round_coordinates(params)
+    data = weather_cache.get_or_fetch(endpoint, params, fetch_from_openweathermap)
+    return data if data is not None else stale_weather(endpoint, params)
 
-        response = (
-            f"🌤 **Погода в {city}**\n"
-            f"🌡 Температура: *{temp}°C*\n"
-            f"📖 Описание: *{description}*"
+
+def stale_weather(endpoint, params):
+    """
+    Устаревший ответ на время сбоя OpenWeatherMap. В кэш он не возвращается,
+    поэтому после восстановления сервиса следующий запрос сразу идёт за свежими данными.
+    """
+    data = weather_cache.get_stale(endpoint, params)
+    if data is not None:
+        logging.warning(f"OpenWeatherMap недоступен, отдаём устаревшие данные для {endpoint}")
+    return data
+
+
+# Асинхронный клиент OpenWeatherMap (режим BOT_MODE=async)
+aio_session = None
+
+
+def get_aio_session():
+    """ Общая aiohttp-сессия; создаётся лениво внутри работающего цикла событий """
+    global aio_session
+    if aio_session is None or aio_session.closed:
+        aio_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100),
+            timeout=aiohttp.ClientTimeout(sock_connect=WEATHER_TIMEOUT[0], sock_read=WEATHER_TIMEOUT[1]),
         )
+    return aio_session
+
+
+def backoff_delay(attempt):
+    """ Экспоненциальная задержка с джиттером, как у urllib3 Retry в синхронном клиенте """
+    return 0.5 * (2 ** attempt) + random.uniform(0, 0.5)
 
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("📅 Погода на завтра", callback_data=f"forecast_{city}"))
-        markup.add(types.InlineKeyboardButton("🔔 Получать уведомления", callback_data=f"notify_{city}"))
 
-        bot.send_photo(chat_id, icon_url, caption=response, parse_mode="Markdown", reply_markup=markup)
+async def fetch_from_openweathermap_async(endpoint, params):
+    """ Асинхронный запрос к OpenWeatherMap без кэша; None, если сервис недоступен """
+    if not weather_breaker.allow():
+        return None
+
+    started = time.monotonic()
+    query = {**params, "appid": API_KEY, "units": "metric"}
+    try:
+        for attempt in range(WEATHER_RETRIES + 1):
+            last_attempt = attempt == WEATHER_RETRIES
+            try:
+                async with get_aio_session().get(WEATHER_URL.format(endpoint), params=query) as response:
+                    if response.status in WEATHER_RETRY_STATUSES and not last_attempt:
+                        await asyncio.sleep(backoff_delay(attempt))
+                        continue
+                    if response.status >= 500 or response.status == 429:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+                    data = await response.json(content_type=None)
+                    weather_breaker.record(True)
+                    return data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # Как и в синхронном клиенте, повторяем только ошибки соединения, но не таймаут чтения
+                read_timeout = isinstance(e, asyncio.TimeoutError) and not isinstance(e, aiohttp.ConnectionTimeoutError)
+                if last_attempt or read_timeout:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
     except Exception as e:
+        weather_breaker.record(False)
+        count_error("weather_api")
+        logging.error(f"Ошибка запроса к OpenWeatherMap: {e}")
+        return None
+    finally:
+        weather_latency[endpoint].observe(time.monotonic() - started)
+
+
+@instrumented("make_weather_request", call_latency)
+async def make_weather_request_async(endpoint, params):
+    """ Асинхронный вариант make_weather_request с тем же кэшем """
+    params = round_coordinates(params)
+    data = await weather_cache.get_or_fetch_async(endpoint, params, fetch_from_openweathermap_async)
+    return data if data is not None else stale_weather(endpoint, params)
+
+
+def build_weather_message(city, data):
+    """ Код иконки, текст и клавиатура по ответу OpenWeatherMap """
+    temp = round(data["main"]["temp"])
+    description = data["weather"][0]["description"].capitalize()
+    icon_code = data["weather"][0]["icon"]
+
+    response = (
+        f"🌤 **Погода в {city}**\n"
+        f"🌡 Температура: *{temp}°C*\n"
+        f"📖 Описание: *{description}*"
+    )
+
+    return icon_code, response, build_city_markup(city)
+
+
+# Описания 400, которые относятся к самому file_id; остальные 400 (разметка, кнопки) повтор по URL не исправит
+STALE_FILE_ID_ERROR = re.compile(r"wrong (remote )?file id|wrong file identifier|file reference", re.IGNORECASE)
+
+
+def is_stale_file_id_error(error, cached):
+    """ Telegram отверг сохранённый file_id — иконку можно переотправить по URL """
+    return (
+        cached
+        and isinstance(error, (telebot.apihelper.ApiTelegramException, asyncio_helper.ApiTelegramException))
+        and error.error_code == 400
+        and bool(STALE_FILE_ID_ERROR.search(error.description or ""))
+    )
+
+
+def icon_fallback_photo(icon_code, error, cached):
+    """ URL иконки для повторной отправки, если Telegram отверг сохранённый file_id; иначе пробрасывает error """
+    # Таймауты, 429 и 403 повторять по URL бессмысленно
+    if not is_stale_file_id_error(error, cached):
+        raise error
+    weather_icons.forget(icon_code)
+    return ICON_URL.format(icon_code)
+
+
+def send_weather_photo(chat_id, icon_code, caption, reply_markup=None):
+    """ Отправка иконки по file_id; при первой отправке или устаревшем file_id — по URL """
+    cached = weather_icons.is_cached(icon_code)
+    try:
+        message = bot.send_photo(chat_id, weather_icons.photo(icon_code), caption=caption, parse_mode="Markdown", reply_markup=reply_markup)
+    except Exception as e:
+        message = bot.send_photo(chat_id, icon_fallback_photo(icon_code, e, cached), caption=caption, parse_mode="Markdown", reply_markup=reply_markup)
+    weather_icons.remember(icon_code, message)
+    return message
+
+
+SERVICE_UNAVAILABLE_TEXT = "⚠️ Сервис погоды временно недоступен, попробуйте позже."
+
+
+def city_not_found_text(city):
+    return f"⚠️ Город **{city}** не найден."
+
+
+def weather_error_text(city, data):
+    """ Текст ошибки по ответу make_weather_request; None — ответ можно показывать """
+    if data is None:
+        # OpenWeatherMap не ответил, а в кэше ничего нет: город тут ни при чём
+        return SERVICE_UNAVAILABLE_TEXT
+    if data.get("cod") != 200:
+        return city_not_found_text(city)
+    return None
+
+
+def location_error_text(data):
+    """ То же для запроса погоды по координатам """
+    if data is None:
+        return SERVICE_UNAVAILABLE_TEXT
+    if data.get("cod") != 200:
+        return _("⚠️ Не удалось определить ваш город. Попробуйте снова.")
+    return None
+
+
+WEATHER_PROCESSING_ERROR_TEXT = "❌ Произошла ошибка при обработке данных о погоде."
+
+
+def weather_reply(city, data):
+    """ Код иконки, текст и клавиатура для ответа пользователю, либо (None, текст ошибки, None) """
+    error_text = weather_error_text(city, data)
+    if error_text:
+        return None, error_text, None
+    try:
+        return build_weather_message(city, data)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
         logging.error(f"Ошибка обработки данных погоды: {e}")
-        bot.send_message(chat_id, "❌ Произошла ошибка при обработке данных о погоде.")
+        return None, WEATHER_PROCESSING_ERROR_TEXT, None
+
+
+def fetch_weather(chat_id, city):
+    data = make_weather_request("weather", {"q": city})
+    icon_code, response, markup = weather_reply(city, data)
+
+    if icon_code is None:
+        bot.send_message(chat_id, response)
+        return
+
+    send_weather_photo(chat_id, icon_code, response, markup)
 
 
 @bot.message_handler(content_types=['location'])
+@instrumented("handle_location")
 def handle_location(message):
     if message.location:
         lat, lon = message.location.latitude, message.location.longitude
         data = make_weather_request("weather", {"lat": lat, "lon": lon})
 
-        if data and data.get("cod") == 200:
+        error_text = location_error_text(data)
+        if error_text:
+            bot.send_message(message.chat.id, error_text)
+        else:
             city = data.get("name")
             bot.send_message(message.chat.id, _("📍 Вы находитесь в **{}**. Получаем погоду…").format(city), parse_mode="Markdown")
             fetch_weather(message.chat.id, city)
-        else:
-            bot.send_message(message.chat.id, _("⚠️ Не удалось определить ваш город. Попробуйте снова."))
 
 
 @bot.message_handler(commands=["users_count"])
+@instrumented("users_count")
 def users_count(message):
-    admin_id = int(os.getenv("ADMIN_ID", 0))
-
-    if message.chat.id == admin_id:
-        count = execute_query("SELECT COUNT(*) FROM telegram_users;", fetchone=True)[0]
+    if is_admin(message.chat.id):
+        try:
+            count = cached_users_count()
+        except Exception:
+            bot.send_message(message.chat.id, DB_ERROR_TEXT)
+            return
         bot.send_message(message.chat.id, _("👥 Всего пользователей: {}").format(count))
     else:
         bot.send_message(message.chat.id, _("🚫 У вас нет доступа к этой информации."))
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("notify_"))
+@instrumented("subscribe_notifications")
 def subscribe_notifications(call):
     city = call.data.replace("notify_", "")
     user_id = call.message.chat.id
 
-    execute_query(
-        "INSERT INTO weather_subscriptions (user_id, city) VALUES (%s, %s) "
-        "ON CONFLICT (user_id) DO UPDATE SET city = EXCLUDED.city;",
-        (user_id, city)
-    )
+    subscription_writer.put(user_id, city)
     bot.send_message(user_id, f"✅ Теперь вы будете получать ежедневные уведомления о погоде в **{city}**!")
 
 
 @bot.message_handler(commands=['unsubscribe'])
+@instrumented("unsubscribe_notifications")
 def unsubscribe_notifications(message):
-    execute_query("DELETE FROM weather_subscriptions WHERE user_id = %s;", (message.chat.id,))
+    subscription_writer.put(message.chat.id, None)
     bot.send_message(message.chat.id, "🚫 Вы отписались от уведомлений о погоде.")
 
 
-def send_weather_notifications():
-    subscriptions = execute_query("SELECT user_id, city FROM weather_subscriptions;", fetchall=True)
-    for user_id, city in subscriptions:
-        fetch_weather(user_id, city)
+# Лимиты Telegram: ~30 сообщений в секунду всего и 1 сообщение в секунду на чат
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", 8))
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_INTERVAL = 1.0
+# Лимит Telegram общий на токен, а ограничитель у каждого процесса свой: при нескольких репликах
+# делим лимит между ними, иначе N реплик вместе шлют N×30 сообщений в секунду
+BOT_REPLICAS = max(1, int(os.getenv("BOT_REPLICAS", 1)))
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("forecast_"))
 
-def forecast_weather(call):
-    city = call.data.replace("forecast_", "")
-    user_id = call.message.chat.id
+class RateLimiter:
+    """ Ограничитель скорости отправки: общий лимит и минимальный интервал на чат """
 
-    # Запрашиваем прогноз погоды на 1 день вперёд
-    data = make_weather_request("forecast", {"q": city, "cnt": 8})  # 8 временных отметок (24 часа)
+    def __init__(self, rate, chat_interval):
+        self.interval = 1.0 / rate
+        self.chat_interval = chat_interval
+        self.next_slot = 0.0
+        self.chat_next_slot = {}
+        self.lock = threading.Lock()
 
-    if not data or data.get("cod") != "200":
-        bot.send_message(user_id, f"⚠️ Не удалось получить прогноз погоды для **{city}**.")
-        return
+    def acquire(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot, self.chat_next_slot.get(chat_id, 0.0))
+            self.next_slot = slot + self.interval
+            self.chat_next_slot[chat_id] = slot + self.chat_interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
 
-        # Получаем данные о погоде на следующий день
-    tomorrow = datetime.now(timezone.utc) + timedelta(days=1)
-    next_day_data = [entry for entry in data["list"] if datetime.fromtimestamp(entry["dt"], timezone.utc).date() == tomorrow.date()]
 
+def normalize_city(city):
+    """ Нормализация названия города для группировки подписчиков """
+    return " ".join(city.split()).casefold()
 
 
-    if not next_day_data:
-        bot.send_message(user_id, f"⚠️ Прогноз на завтра для **{city}** не найден.")
-        return
+def send_weather_notifications(subscriptions):
+    """
+    Рассылка уведомлений: один запрос погоды на город, отправка пулом потоков.
+    subscriptions — строки (user_id, city, send); при send=False погода нужна только для расписания.
+    Возвращает ответы OpenWeatherMap по нормализованным названиям городов.
+    """
+    started = time.monotonic()
 
-    # Рассчитываем среднюю температуру и общее описание погоды
-    avg_temp = sum(entry["main"]["temp"] for entry in next_day_data) / len(next_day_data)
-    descriptions = {entry["weather"][0]["description"] for entry in next_day_data}
-    weather_description = ", ".join(descriptions).capitalize()
+    # Группируем подписчиков по нормализованному названию города
+    groups = defaultdict(list)
+    for user_id, city, send in subscriptions:
+        groups[normalize_city(city)].append((user_id, city, send))
 
-    # Берём иконку погоды из первой записи
-    icon_code = next_day_data[0]["weather"][0]["icon"]
-    icon_url = f"http://openweathermap.org/img/wn/{icon_code}@4x.png"
+    limiter = RateLimiter(TELEGRAM_GLOBAL_RATE / BOT_REPLICAS, TELEGRAM_CHAT_INTERVAL)
+    stats = {"sent": 0, "failed": 0}
+    stats_lock = threading.Lock()
 
-    response = (
-        f"📅 **Прогноз погоды на завтра в {city}**\n"
-        f"🌡 Средняя температура: *{round(avg_temp)}°C*\n"
-        f"📖 Описание: *{weather_description}*"
+    def deliver(user_id, city, data):
+        try:
+            limiter.acquire(user_id)
+            icon_code, response, markup = weather_reply(city, data)
+            if icon_code is None:
+                bot.send_message(user_id, response)
+            else:
+                send_weather_photo(user_id, icon_code, response, markup)
+            outcome = "sent"
+        except Exception as e:
+            logging.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+            outcome = "failed"
+        with stats_lock:
+            stats[outcome] += 1
+
+    with ThreadPoolExecutor(max_workers=NOTIFY_WORKERS) as executor:
+        fetch_started = time.monotonic()
+        weather = dict(zip(groups, executor.map(
+            lambda members: make_weather_request("weather", {"q": members[0][1]}), groups.values()
+        )))
+        fetch_elapsed = time.monotonic() - fetch_started
+
+        for key, members in groups.items():
+            # OpenWeatherMap недоступен: не шлём «город не найден», планировщик повторит позже
+            if weather[key] is None:
+                continue
+            for user_id, city, send in members:
+                if send:
+                    executor.submit(deliver, user_id, city, weather[key])
+
+    elapsed = time.monotonic() - started
+    total = stats["sent"] + stats["failed"]
+    logging.info(
+        f"Уведомления: {total} подписчиков, {len(groups)} городов, "
+        f"отправлено {stats['sent']}, ошибок {stats['failed']}, "
+        f"запросы погоды {fetch_elapsed:.2f}s, всего {elapsed:.2f}s "
+        f"({total / elapsed if elapsed else 0:.1f} сообщ./с)"
     )
+    return weather
+
+
+# Планировщик уведомлений: у каждой подписки своё время следующей отправки (next_send_at)
+NOTIFY_LOCAL_HOUR = int(os.getenv("NOTIFY_LOCAL_HOUR", 8))
+NOTIFY_SPREAD_SECONDS = int(os.getenv("NOTIFY_SPREAD_MINUTES", 60)) * 60
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 500))
+NOTIFY_RETRY_DELAY = timedelta(minutes=15)
+# Уведомления, просроченные дольше этого (бот лежал), не рассылаем залпом, а только переносим на завтра
+NOTIFY_GRACE = timedelta(minutes=int(os.getenv("NOTIFY_GRACE_MINUTES", 60)))
+
+NOTIFICATION_SCHEMA_QUERIES = (
+    "ALTER TABLE weather_subscriptions ADD COLUMN IF NOT EXISTS next_send_at TIMESTAMPTZ;",
+    "CREATE INDEX IF NOT EXISTS weather_subscriptions_next_send_at_idx "
+    "ON weather_subscriptions (next_send_at NULLS FIRST);",
+)
+
+# Строки, захваченные одним процессом, остальные пропускают (SKIP LOCKED) до конца его транзакции
+CLAIM_DUE_QUERY = """
+    SELECT user_id, city, next_send_at IS NOT NULL AND next_send_at >= now() - %s
+    FROM weather_subscriptions
+    WHERE next_send_at IS NULL OR next_send_at <= now()
+    ORDER BY next_send_at NULLS FIRST
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED;
+"""
+RESCHEDULE_QUERY = """
+    UPDATE weather_subscriptions AS s
+    SET next_send_at = v.next_send_at
+    FROM (VALUES %s) AS v (user_id, next_send_at)
+    WHERE s.user_id = v.user_id;
+"""
+
+
+def ensure_notification_schema():
+    for query in NOTIFICATION_SCHEMA_QUERIES:
+        execute_query(query)
+
+
+def next_send_time(user_id, utc_offset, now):
+    """ Ближайшие NOTIFY_LOCAL_HOUR:00 по местному времени города, со сдвигом по user_id против пиковой нагрузки """
+    local_tz = timezone(timedelta(seconds=utc_offset))
+    local_now = now.astimezone(local_tz)
+    target = local_now.replace(hour=NOTIFY_LOCAL_HOUR, minute=0, second=0, microsecond=0)
+    if NOTIFY_SPREAD_SECONDS:
+        target += timedelta(seconds=user_id % NOTIFY_SPREAD_SECONDS)
+    if target <= local_now:
+        target += timedelta(days=1)
+    return target.astimezone(timezone.utc)
+
+
+def send_due_notifications():
+    """ Раз в минуту: забираем пачками подписки, у которых подошло время, рассылаем и переносим на следующий день """
+    conn = conn_pool.getconn()
+    try:
+        # Блокировки держатся до commit: при падении процесса строки снова станут «должными»
+        conn.autocommit = False
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(CLAIM_DUE_QUERY, (NOTIFY_GRACE, NOTIFY_BATCH_SIZE))
+                rows = cur.fetchall()
+                if not rows:
+                    conn.commit()
+                    return
+
+                weather = send_weather_notifications(rows)
+
+                now = datetime.now(timezone.utc)
+                schedule = []
+                for user_id, city, _send in rows:
+                    data = weather[normalize_city(city)]
+                    if data is None:
+                        schedule.append((user_id, now + NOTIFY_RETRY_DELAY))
+                    else:
+                        schedule.append((user_id, next_send_time(user_id, data.get("timezone", 0), now)))
+                execute_values(cur, RESCHEDULE_QUERY, schedule, page_size=len(schedule))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn_pool.putconn(conn)
+
+# Прогноз: один запрос полного ряда 5 дней / 3 часа на город, виды строятся из хранилища
+FORECAST_VIEWS = {1: "на завтра", 3: "на 3 дня", 7: "на неделю"}
+FORECAST_CALLBACK = re.compile(r"^forecast(\d*)_(.+)$", re.DOTALL)
+forecast_store = ForecastStore(WEATHER_CACHE_MAX_ENTRIES)
+
+
+def parse_forecast_callback(callback_data):
+    """ forecast_{city} — завтра (старые кнопки), forecast{дней}_{city} — 3 дня или неделя """
+    match = FORECAST_CALLBACK.match(callback_data)
+    days = int(match.group(1) or 1)
+    return match.group(2), days if days in FORECAST_VIEWS else 1
+
+
+def build_forecast_message(city, data, days=1):
+    """ Код иконки и текст прогноза на days дней начиная с завтра, либо (None, текст ошибки) """
+    if data is None:
+        return None, SERVICE_UNAVAILABLE_TEXT
+    if data.get("cod") != "200":
+        return None, f"⚠️ Не удалось получить прогноз погоды для **{city}**."
+
+    # «Завтра» считается по местному времени города, а не по UTC
+    series = forecast_store.get(normalize_city(city), data)
+    tomorrow = series.local_day(int(time.time())) + 1
+    summaries = series.days_from(tomorrow, days)
+
+    if not summaries:
+        return None, f"⚠️ Прогноз {FORECAST_VIEWS[days]} для **{city}** не найден."
+
+    if days == 1:
+        day = summaries[0]
+        response = (
+            f"📅 **Прогноз погоды на завтра в {city}**\n"
+            f"🌡 Средняя температура: *{round(day.temp_mean)}°C* ({round(day.temp_min)}…{round(day.temp_max)}°C)\n"
+            f"📖 Описание: *{day.description.capitalize()}*"
+        )
+    else:
+        lines = [f"📅 **Прогноз погоды {FORECAST_VIEWS[days]} в {city}**"]
+        for day in summaries:
+            date = datetime.fromtimestamp(day.day * SECONDS_PER_DAY, timezone.utc).strftime("%d.%m")
+            lines.append(f"*{date}*: 🌡 {round(day.temp_min)}…{round(day.temp_max)}°C, {day.description}")
+        response = "\n".join(lines)
+
+    return summaries[0].icon, response
+
+
+@bot.callback_query_handler(func=lambda call: FORECAST_CALLBACK.match(call.data))
+@instrumented("forecast_weather")
+def forecast_weather(call):
+    city, days = parse_forecast_callback(call.data)
+    user_id = call.message.chat.id
+
+    # Полный ряд на 5 дней; повторные нажатия берут его из кэша и хранилища прогнозов
+    data = make_weather_request("forecast", {"q": city})
+    icon_code, response = build_forecast_message(city, data, days)
+
+    if icon_code is None:
+        bot.send_message(user_id, response)
+        return
+
+    send_weather_photo(user_id, icon_code, response)
+
+ASK_CITY_TEXT = "Введите название города, для которого хотите узнать погоду:"
+INVALID_CITY_TEXT = "⚠️ Пожалуйста, введите корректное название города."
 
-    bot.send_photo(user_id, icon_url, caption=response, parse_mode="Markdown")
 
 @bot.message_handler(func=lambda message: message.text == _('🏙 Выбрать город'))
+@instrumented("ask_city")
 def ask_city(message):
-    bot.send_message(message.chat.id, "Введите название города, для которого хотите узнать погоду:")
+    bot.send_message(message.chat.id, ASK_CITY_TEXT)
     bot.register_next_step_handler(message, handle_city_input)
 
 
+@instrumented("handle_city_input")
 def handle_city_input(message):
     city = message.text.strip()
     if not city:
-        bot.send_message(message.chat.id, "⚠️ Пожалуйста, введите корректное название города.")
+        bot.send_message(message.chat.id, INVALID_CITY_TEXT)
         return
     
     fetch_weather(message.chat.id, city)
 
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(send_weather_notifications, "interval", hours=24, next_run_time=datetime.now() + timedelta(seconds=10))
-scheduler.start()
+# Метрики в формате Prometheus (METRICS_PORT) и сводка для администратора (/stats)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# По умолчанию выключено: у каждой реплики на одной машине должен быть свой порт
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+
+def queue_depths():
+    """ Очередь обновлений пула telebot и несброшенные отложенные записи """
+    depths = {writer.name: len(writer.pending) for writer in (user_writer, subscription_writer, icon_writer)}
+    worker_pool = getattr(bot, "worker_pool", None)
+    if worker_pool is not None:
+        depths["telebot_updates"] = worker_pool.tasks.qsize()
+    return depths
+
+
+def render_histograms(metric, label, histograms, lines):
+    lines.append(f"# TYPE {metric} histogram")
+    for key, histogram in sorted(histograms.items()):
+        snapshot = histogram.snapshot()
+        cumulative = 0
+        for bound, count in zip(snapshot["buckets"] + ("+Inf",), snapshot["counts"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{label}="{key}"}} {snapshot["sum"]}')
+        lines.append(f'{metric}_count{{{label}="{key}"}} {snapshot["count"]}')
+
+
+def render_metrics():
+    lines = []
+    render_histograms("bot_handler_latency_seconds", "handler", handler_latency, lines)
+    render_histograms("bot_call_latency_seconds", "function", call_latency, lines)
+    render_histograms("bot_telegram_latency_seconds", "method", telegram_latency, lines)
+    render_histograms("bot_weather_api_latency_seconds", "endpoint", weather_latency, lines)
+    render_histograms("bot_db_query_latency_seconds", "statement", db_latency, lines)
+    render_histograms("bot_db_pool_wait_seconds", "pool", {"main": conn_pool.wait_latency}, lines)
+
+    with metrics_lock:
+        errors = dict(error_counts)
+        running = dict(in_flight)
+    lines.append("# TYPE bot_errors_total counter")
+    lines.extend(f'bot_errors_total{{source="{source}"}} {count}' for source, count in sorted(errors.items()))
+    lines.append("# TYPE bot_in_flight gauge")
+    lines.extend(f'bot_in_flight{{name="{name}"}} {count}' for name, count in sorted(running.items()))
+
+    cache = weather_cache.stats()
+    lines.append("# TYPE bot_weather_cache_hits_total counter")
+    lines.append(f"bot_weather_cache_hits_total {cache['hits']}")
+    lines.append("# TYPE bot_weather_cache_misses_total counter")
+    lines.append(f"bot_weather_cache_misses_total {cache['misses']}")
+    lines.append("# TYPE bot_weather_cache_entries gauge")
+    lines.append(f"bot_weather_cache_entries {cache['size']}")
+    lines.append("# TYPE bot_weather_breaker_open gauge")
+    lines.append(f"bot_weather_breaker_open {int(weather_breaker.is_open)}")
+
+    pool = conn_pool.stats()
+    for key in ("in_use", "max", "open"):
+        lines.append(f"# TYPE bot_db_pool_{key} gauge")
+        lines.append(f"bot_db_pool_{key} {pool[key]}")
+    for key in ("waits", "timeouts"):
+        lines.append(f"# TYPE bot_db_pool_{key}_total counter")
+        lines.append(f"bot_db_pool_{key}_total {pool[key]}")
+
+    lines.append("# TYPE bot_queue_depth gauge")
+    lines.extend(f'bot_queue_depth{{queue="{queue}"}} {depth}' for queue, depth in sorted(queue_depths().items()))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server():
+    """ Локальный HTTP-эндпоинт /metrics; METRICS_PORT=0 отключает его """
+    if not METRICS_PORT:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        # Порт занят другой репликой: бот работает дальше, просто без /metrics
+        logging.error(f"Не удалось открыть порт метрик {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+
+def escape_markdown(text):
+    """ Экранирование для parse_mode="Markdown": иначе "_" в именах обработчиков ломает разметку """
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def stats_text():
+    """ Краткая сводка для /stats (parse_mode="Markdown") """
+    cache = weather_cache.stats()
+    lookups = cache["hits"] + cache["misses"]
+    pool = conn_pool.stats()
+    with metrics_lock:
+        errors = dict(error_counts)
+
+    lines = ["📊 **Статистика бота**"]
+    try:
+        lines.append(f"👥 Пользователей: {cached_users_count()}")
+    except Exception:
+        lines.append("👥 Пользователей: БД недоступна")
+    for name, histogram in sorted(handler_latency.items()):
+        lines.append(
+            f"⏱ {escape_markdown(name)}: {histogram.count} вызовов, p50 ≤ {histogram.quantile(0.5) * 1000:.0f} мс, "
+            f"p99 ≤ {histogram.quantile(0.99) * 1000:.0f} мс"
+        )
+    lines.append(
+        f"🗄 Кэш погоды: {cache['hits']}/{lookups} попаданий, {cache['size']} записей, "
+        f"OpenWeatherMap {'недоступен' if weather_breaker.is_open else 'в порядке'}"
+    )
+    lines.append(f"🔌 Пул БД: {pool['in_use']}/{pool['max']} занято, ожиданий {pool['waits']}, таймаутов {pool['timeouts']}")
+    lines.append("📬 Очереди: " + ", ".join(f"{escape_markdown(queue)} {depth}" for queue, depth in sorted(queue_depths().items())))
+    if errors:
+        lines.append("❗ Ошибки: " + ", ".join(f"{escape_markdown(source)} {count}" for source, count in sorted(errors.items())))
+    return "\n".join(lines)
+
+
+@bot.message_handler(commands=["stats"])
+@instrumented("stats")
+def stats(message):
+    if is_admin(message.chat.id):
+        bot.send_message(message.chat.id, stats_text(), parse_mode="Markdown")
+    else:
+        bot.send_message(message.chat.id, _("🚫 У вас нет доступа к этой информации."))
+
+
+# Асинхронный режим: те же тексты, клавиатуры и запросы, но без блокировки потоков
+def create_async_bot():
+    """ AsyncTeleBot с теми же обработчиками, что и у синхронного бота """
+    async_bot = instrument_bot(AsyncTeleBot(BOT_TOKEN))
+    awaiting_city = set()
+
+    # Решения (какую иконку слать, когда переходить на URL, какой текст ошибки) — в общих функциях,
+    # здесь только await вызовов Bot API
+    async def send_weather_photo_async(chat_id, icon_code, caption, reply_markup=None):
+        cached = weather_icons.is_cached(icon_code)
+        try:
+            message = await async_bot.send_photo(chat_id, weather_icons.photo(icon_code), caption=caption, parse_mode="Markdown", reply_markup=reply_markup)
+        except Exception as e:
+            message = await async_bot.send_photo(chat_id, icon_fallback_photo(icon_code, e, cached), caption=caption, parse_mode="Markdown", reply_markup=reply_markup)
+        weather_icons.remember(icon_code, message)
+        return message
+
+    async def send_weather(chat_id, city):
+        data = await make_weather_request_async("weather", {"q": city})
+        icon_code, response, markup = weather_reply(city, data)
+
+        if icon_code is None:
+            await async_bot.send_message(chat_id, response)
+            return
+
+        await send_weather_photo_async(chat_id, icon_code, response, markup)
+
+    @async_bot.message_handler(commands=['start'])
+    @instrumented("start")
+    async def start_async(message):
+        save_user(message.from_user)
+        await async_bot.send_message(message.chat.id, start_text(), reply_markup=build_start_markup(), parse_mode="Markdown")
+
+    @async_bot.message_handler(content_types=['location'])
+    @instrumented("handle_location")
+    async def handle_location_async(message):
+        if message.location:
+            lat, lon = message.location.latitude, message.location.longitude
+            data = await make_weather_request_async("weather", {"lat": lat, "lon": lon})
+
+            error_text = location_error_text(data)
+            if error_text:
+                await async_bot.send_message(message.chat.id, error_text)
+            else:
+                city = data.get("name")
+                await async_bot.send_message(message.chat.id, _("📍 Вы находитесь в **{}**. Получаем погоду…").format(city), parse_mode="Markdown")
+                await send_weather(message.chat.id, city)
+
+    @async_bot.message_handler(commands=["users_count"])
+    @instrumented("users_count")
+    async def users_count_async(message):
+        if is_admin(message.chat.id):
+            try:
+                count = await asyncio.to_thread(cached_users_count)
+            except Exception:
+                await async_bot.send_message(message.chat.id, DB_ERROR_TEXT)
+                return
+            await async_bot.send_message(message.chat.id, _("👥 Всего пользователей: {}").format(count))
+        else:
+            await async_bot.send_message(message.chat.id, _("🚫 У вас нет доступа к этой информации."))
+
+    @async_bot.callback_query_handler(func=lambda call: call.data.startswith("notify_"))
+    @instrumented("subscribe_notifications")
+    async def subscribe_notifications_async(call):
+        city = call.data.replace("notify_", "")
+        user_id = call.message.chat.id
+
+        subscription_writer.put(user_id, city)
+        await async_bot.send_message(user_id, f"✅ Теперь вы будете получать ежедневные уведомления о погоде в **{city}**!")
+
+    @async_bot.message_handler(commands=['unsubscribe'])
+    @instrumented("unsubscribe_notifications")
+    async def unsubscribe_notifications_async(message):
+        subscription_writer.put(message.chat.id, None)
+        await async_bot.send_message(message.chat.id, "🚫 Вы отписались от уведомлений о погоде.")
+
+    @async_bot.callback_query_handler(func=lambda call: FORECAST_CALLBACK.match(call.data))
+    @instrumented("forecast_weather")
+    async def forecast_weather_async(call):
+        city, days = parse_forecast_callback(call.data)
+        user_id = call.message.chat.id
+
+        data = await make_weather_request_async("forecast", {"q": city})
+        icon_code, response = build_forecast_message(city, data, days)
+
+        if icon_code is None:
+            await async_bot.send_message(user_id, response)
+            return
+
+        await send_weather_photo_async(user_id, icon_code, response)
+
+    @async_bot.message_handler(commands=["stats"])
+    @instrumented("stats")
+    async def stats_async(message):
+        if is_admin(message.chat.id):
+            await async_bot.send_message(message.chat.id, await asyncio.to_thread(stats_text), parse_mode="Markdown")
+        else:
+            await async_bot.send_message(message.chat.id, _("🚫 У вас нет доступа к этой информации."))
+
+    @async_bot.message_handler(func=lambda message: message.text == _('🏙 Выбрать город'))
+    @instrumented("ask_city")
+    async def ask_city_async(message):
+        # В AsyncTeleBot нет register_next_step_handler, запоминаем чат сами
+        awaiting_city.add(message.chat.id)
+        await async_bot.send_message(message.chat.id, ASK_CITY_TEXT)
+
+    @async_bot.message_handler(func=lambda message: message.chat.id in awaiting_city)
+    @instrumented("handle_city_input")
+    async def handle_city_input_async(message):
+        awaiting_city.discard(message.chat.id)
+        city = (message.text or "").strip()
+        if not city:
+            await async_bot.send_message(message.chat.id, INVALID_CITY_TEXT)
+            return
+
+        await send_weather(message.chat.id, city)
+
+    return async_bot
+
+
+async def run_async_bot():
+    async_bot = create_async_bot()
+    polling = asyncio.ensure_future(async_bot.infinity_polling())
+    # SIGTERM прерывает long polling сразу, не дожидаясь ответа getUpdates
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, polling.cancel)
+    try:
+        await polling
+    except asyncio.CancelledError:
+        logging.info("Получен SIGTERM, останавливаем бота")
+        # Даём начатым обработчикам дописать свои записи в очереди
+        handlers = asyncio.all_tasks() - {asyncio.current_task()}
+        if handlers:
+            await asyncio.wait(handlers, timeout=SHUTDOWN_TIMEOUT)
+    finally:
+        if aio_session is not None:
+            await aio_session.close()
+
+
+def handle_sigterm(signum, frame):
+    """ SIGTERM (docker stop, Railway) останавливает бота так же, как Ctrl+C """
+    logging.info("Получен SIGTERM, останавливаем бота")
+    bot.stop_polling()
+    # telebot обрабатывает KeyboardInterrupt в цикле опроса и выходит из infinity_polling
+    raise KeyboardInterrupt
+
+
+# Режим работы: threaded (telebot.TeleBot, по умолчанию) или async (AsyncTeleBot)
+BOT_MODE = os.getenv("BOT_MODE", "threaded")
+# Сколько ждать начатые обработчики при остановке, с
+SHUTDOWN_TIMEOUT = 5.0
+
+
+def main():
+    ensure_notification_schema()
+    weather_icons.load()
+    start_metrics_server()
+
+    # Рассылка уведомлений в обоих режимах идёт из фонового потока через синхронный клиент
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(send_due_notifications, "interval", minutes=1, max_instances=1, coalesce=True)
+    scheduler.start()
+
+    # Запуск бота; при остановке (Ctrl+C или SIGTERM) дописываем отложенные записи
+    try:
+        if BOT_MODE == "async":
+            asyncio.run(run_async_bot())
+        else:
+            signal.signal(signal.SIGTERM, handle_sigterm)
+            bot.infinity_polling(none_stop=True)
+            # Дожидаемся обработчиков, которые уже выполняются в пуле
+            bot.worker_pool.close()
+    finally:
+        scheduler.shutdown(wait=False)
+        close_writers()
+
 
-# Запуск бота
-bot.infinity_polling(none_stop=True)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,121 @@
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+SECONDS_PER_DAY = 86400
+
+# Сводка по одному местному дню
+DailyForecast = namedtuple(
+    "DailyForecast", "day temp_min temp_max temp_mean humidity wind_max condition_id description icon"
+)
+
+
+class ForecastSeries:
+    """
+    Пятидневный прогноз с шагом 3 часа в виде колонок array вместо списка JSON-словарей.
+    Описания и иконки хранятся один раз на код погоды (weather.id).
+    """
+
+    __slots__ = ("utc_offset", "timestamps", "temp", "humidity", "wind", "conditions", "descriptions", "icons", "_daily")
+
+    def __init__(self, utc_offset=0):
+        self.utc_offset = utc_offset
+        self.timestamps = array("q")
+        self.temp = array("f")
+        self.humidity = array("B")
+        self.wind = array("f")
+        self.conditions = array("H")
+        self.descriptions = {}
+        self.icons = {}
+        self._daily = None
+
+    @classmethod
+    def from_response(cls, data):
+        """ Разбор ответа эндпоинта forecast """
+        series = cls(data.get("city", {}).get("timezone", 0))
+        for entry in data["list"]:
+            weather = entry["weather"][0]
+            series.timestamps.append(entry["dt"])
+            series.temp.append(entry["main"]["temp"])
+            series.humidity.append(entry["main"]["humidity"])
+            series.wind.append(entry.get("wind", {}).get("speed", 0.0))
+            series.conditions.append(weather["id"])
+            series.descriptions.setdefault(weather["id"], weather["description"])
+            # Для дневной сводки берём дневной вариант иконки
+            series.icons.setdefault(weather["id"], weather["icon"][:2] + "d")
+        return series
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def local_day(self, timestamp):
+        """ Номер местного дня (дни от эпохи) для метки времени UTC """
+        return (timestamp + self.utc_offset) // SECONDS_PER_DAY
+
+    def daily(self):
+        """ Сводки по местным дням; считаются один раз, ряд после разбора не меняется """
+        if self._daily is None:
+            self._daily = self.aggregate()
+        return self._daily
+
+    def aggregate(self):
+        """ Min/max/среднее и преобладающая погода по местным дням за один проход """
+        days = []
+        current = None
+        for ts, temp, humidity, wind, condition in zip(
+            self.timestamps, self.temp, self.humidity, self.wind, self.conditions
+        ):
+            day = (ts + self.utc_offset) // SECONDS_PER_DAY
+            if current is None or current[0] != day:
+                current = [day, temp, temp, 0.0, 0, 0, wind, {}]
+                days.append(current)
+            if temp < current[1]:
+                current[1] = temp
+            if temp > current[2]:
+                current[2] = temp
+            current[3] += temp
+            current[4] += 1
+            current[5] += humidity
+            if wind > current[6]:
+                current[6] = wind
+            current[7][condition] = current[7].get(condition, 0) + 1
+
+        result = []
+        for day, temp_min, temp_max, temp_sum, count, humidity_sum, wind_max, conditions in days:
+            condition = max(conditions, key=conditions.get)
+            result.append(DailyForecast(
+                day, temp_min, temp_max, temp_sum / count, humidity_sum / count, wind_max,
+                condition, self.descriptions[condition], self.icons[condition],
+            ))
+        return result
+
+    def days_from(self, first_day, count):
+        """ Сводки за count местных дней, начиная с first_day """
+        return [summary for summary in self.daily() if first_day <= summary.day < first_day + count]
+
+
+class ForecastStore:
+    """
+    Разобранные прогнозы по городам (LRU). Запись актуальна, пока кэш запросов возвращает
+    тот же объект ответа, поэтому своё время жизни хранилищу не нужно.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, data):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] is data:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        series = ForecastSeries.from_response(data)
+        with self.lock:
+            self.entries[key] = (data, series)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return series
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+
+from tests.stubs import start_http_stub, start_pg_stub, stub_environment
+
+
+@pytest.fixture(scope="session")
+def stubs():
+    """ Заглушки Bot API, OpenWeatherMap и PostgreSQL на время сессии и окружение, указывающее на них """
+    http_server, calls = start_http_stub(0)
+    pg_server = start_pg_stub(0)
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in stub_environment(http_server, pg_server).items():
+            patch.setenv(name, value)
+        yield SimpleNamespace(http=http_server, calls=calls, pg=pg_server)
+    for server in (http_server, pg_server):
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="session")
+def forecast(stubs):
+    # forecast.py подключается к БД и Bot API при импорте, поэтому только после заглушек
+    import forecast
+    return forecast
+
+
+@pytest.fixture
+def pg(stubs):
+    """ Заглушка PostgreSQL с пустым журналом запросов и без должных подписок """
+    stubs.pg.queries.clear()
+    stubs.pg.due_batches.clear()
+    return stubs.pg
+
+
+@pytest.fixture
+def make_pool(forecast):
+    """ Отдельные пулы к заглушке; закрываются после теста """
+    pools = []
+
+    def make(maxconn=1, timeout=1.0):
+        pool = forecast.BlockingConnectionPool(
+            0, maxconn, timeout, connection_factory=forecast.PreparedConnection, **forecast.DB_PARAMS
+        )
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.closeall()
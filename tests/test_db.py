@@ -0,0 +1,102 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.pool
+import pytest
+
+
+def test_pool_blocks_until_connection_is_returned(make_pool):
+    pool = make_pool(maxconn=1, timeout=2.0)
+    conn = pool.getconn()
+    waited = []
+
+    def borrow():
+        started = time.monotonic()
+        pool.putconn(pool.getconn())
+        waited.append(time.monotonic() - started)
+
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    time.sleep(0.2)
+    assert not waited
+    pool.putconn(conn)
+    thread.join(2)
+
+    assert waited and waited[0] >= 0.2
+    assert pool.stats()["waits"] == 1
+    assert pool.stats()["in_use"] == 0
+
+
+def test_pool_times_out_when_exhausted(make_pool):
+    pool = make_pool(maxconn=1, timeout=0.1)
+    conn = pool.getconn()
+
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.getconn()
+
+    assert pool.stats()["timeouts"] == 1
+    pool.putconn(conn)
+    pool.putconn(pool.getconn())
+
+
+def test_pool_releases_slot_when_connect_fails(make_pool, monkeypatch):
+    pool = make_pool(maxconn=1, timeout=0.1)
+
+    def refuse(self, key=None):
+        raise psycopg2.OperationalError("connection refused")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(psycopg2.pool.ThreadedConnectionPool, "getconn", refuse)
+        # Без возврата слота вторая попытка упала бы с PoolError по таймауту
+        for _ in range(2):
+            with pytest.raises(psycopg2.OperationalError):
+                pool.getconn()
+
+    pool.putconn(pool.getconn())
+    assert pool.stats() == {"in_use": 0, "max": 1, "open": 1, "waits": 0, "timeouts": 0}
+
+
+def test_execute_prepared_prepares_once_per_connection(forecast, make_pool, pg, monkeypatch):
+    pool = make_pool(maxconn=1)
+    monkeypatch.setattr(forecast, "conn_pool", pool)
+
+    for _ in range(3):
+        assert forecast.execute_prepared("users_count", fetchone=True) == (1000,)
+    # Новое соединение ничего не знает о PREPARE прежнего
+    pool.putconn(pool.getconn(), close=True)
+    forecast.execute_prepared("users_count", fetchone=True)
+
+    prepares = [query for query in pg.queries if query.startswith("PREPARE users_count")]
+    executes = [query for query in pg.queries if query.startswith("EXECUTE users_count")]
+    assert len(prepares) == 2
+    assert len(executes) == 4
+
+
+def test_execute_query_propagates_errors(forecast, make_pool, monkeypatch):
+    pool = make_pool(maxconn=1)
+    monkeypatch.setattr(forecast, "conn_pool", pool)
+    errors = forecast.error_counts["db"]
+
+    with pytest.raises(psycopg2.errors.UndefinedTable):
+        forecast.execute_query("SELECT * FROM missing_table;", fetchall=True)
+
+    assert forecast.error_counts["db"] == errors + 1
+    assert pool.stats()["in_use"] == 0
+    # Соединение после ошибки остаётся рабочим
+    assert forecast.execute_query("SELECT 1;", fetchall=True) == []
+
+
+def test_users_count_replies_with_db_error(forecast, make_pool, monkeypatch):
+    monkeypatch.setattr(forecast, "conn_pool", make_pool(maxconn=1))
+    monkeypatch.setitem(forecast.PREPARED_STATEMENTS, "users_count", "SELECT COUNT(*) FROM missing_table")
+    monkeypatch.setitem(forecast.users_count_cache, "expires", 0.0)
+    monkeypatch.setenv("ADMIN_ID", "42")
+    sent = []
+    monkeypatch.setattr(forecast.bot, "send_message", lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+
+    forecast.users_count(SimpleNamespace(chat=SimpleNamespace(id=42)))
+
+    assert sent == [(42, forecast.DB_ERROR_TEXT)]
@@ -0,0 +1,88 @@
+import pytest
+
+from forecast_store import SECONDS_PER_DAY, ForecastSeries, ForecastStore
+
+UTC_OFFSET = 5 * 3600
+DAY = 20000  # местный день от эпохи
+LOCAL_MIDNIGHT = DAY * SECONDS_PER_DAY - UTC_OFFSET
+
+
+def entry(ts, temp, condition=800, description="ясно", icon="01n", humidity=50, wind=2.0):
+    return {
+        "dt": ts,
+        "main": {"temp": temp, "humidity": humidity},
+        "wind": {"speed": wind},
+        "weather": [{"id": condition, "description": description, "icon": icon}],
+    }
+
+
+def response():
+    """ Два местных дня по 8 точек: в первом 5 раз ясно и 3 раза дождь """
+    entries = []
+    for i in range(8):
+        condition, description, icon = (800, "ясно", "01n") if i < 5 else (500, "дождь", "10n")
+        entries.append(entry(LOCAL_MIDNIGHT + i * 10800, float(i + 1), condition, description, icon, humidity=40 + i, wind=float(i)))
+    for i in range(8):
+        entries.append(entry(LOCAL_MIDNIGHT + SECONDS_PER_DAY + i * 10800, -float(i), 500, "дождь", "10n"))
+    return {"cod": "200", "list": entries, "city": {"timezone": UTC_OFFSET}}
+
+
+def test_local_day_uses_city_offset():
+    series = ForecastSeries.from_response(response())
+    assert series.local_day(LOCAL_MIDNIGHT) == DAY
+    assert series.local_day(LOCAL_MIDNIGHT - 1) == DAY - 1
+    # По UTC эта метка ещё предыдущий день
+    assert LOCAL_MIDNIGHT // SECONDS_PER_DAY == DAY - 1
+
+
+def test_aggregate_per_local_day():
+    first, second = ForecastSeries.from_response(response()).aggregate()
+
+    assert first.day == DAY
+    assert (first.temp_min, first.temp_max, first.temp_mean) == (1.0, 8.0, 4.5)
+    assert first.humidity == pytest.approx(43.5)
+    assert first.wind_max == 7.0
+    assert (first.condition_id, first.description, first.icon) == (800, "ясно", "01d")
+
+    assert second.day == DAY + 1
+    assert (second.temp_min, second.temp_max) == (-7.0, 0.0)
+    assert (second.condition_id, second.icon) == (500, "10d")
+
+
+def test_days_from_and_cached_daily():
+    series = ForecastSeries.from_response(response())
+    assert [summary.day for summary in series.days_from(DAY + 1, 3)] == [DAY + 1]
+    assert [summary.day for summary in series.days_from(DAY, 7)] == [DAY, DAY + 1]
+    assert series.days_from(DAY + 2, 1) == []
+    assert series.daily() is series.daily()
+
+
+def test_store_reuses_series_for_same_response():
+    store = ForecastStore(2)
+    data = response()
+    series = store.get("tashkent", data)
+    assert store.get("tashkent", data) is series
+    # Новый ответ из кэша запросов — новый разбор
+    assert store.get("tashkent", response()) is not series
+
+
+def test_store_evicts_least_recently_used():
+    store = ForecastStore(2)
+    data = {name: response() for name in ("a", "b", "c")}
+    first = store.get("a", data["a"])
+    store.get("b", data["b"])
+    store.get("a", data["a"])
+    store.get("c", data["c"])
+    assert list(store.entries) == ["a", "c"]
+    assert store.get("a", data["a"]) is first
+
+
+@pytest.mark.parametrize("callback_data, expected", [
+    ("forecast_Tashkent", ("Tashkent", 1)),
+    ("forecast3_Tashkent", ("Tashkent", 3)),
+    ("forecast7_New_York", ("New_York", 7)),
+    ("forecast_New_York", ("New_York", 1)),
+    ("forecast5_Tashkent", ("Tashkent", 1)),
+])
+def test_parse_forecast_callback(forecast, callback_data, expected):
+    assert forecast.parse_forecast_callback(callback_data) == expected
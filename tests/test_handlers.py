@@ -0,0 +1,43 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+def location_message(chat_id=7):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), location=SimpleNamespace(latitude=41.3, longitude=69.2))
+
+
+@pytest.mark.parametrize("data, expected", [
+    (None, "SERVICE_UNAVAILABLE_TEXT"),
+    ({"cod": "404", "message": "city not found"}, "⚠️ Не удалось определить ваш город. Попробуйте снова."),
+])
+def test_handle_location_error_text(forecast, monkeypatch, data, expected):
+    expected = getattr(forecast, expected, expected)
+    sent = []
+    monkeypatch.setattr(forecast, "make_weather_request", lambda endpoint, params: data)
+    monkeypatch.setattr(forecast.bot, "send_message", lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+
+    forecast.handle_location(location_message())
+
+    assert sent == [(7, expected)]
+
+
+def test_handle_location_async_reports_outage(forecast, monkeypatch):
+    async def unavailable(endpoint, params):
+        return None
+
+    async def run():
+        async_bot = forecast.create_async_bot()
+        sent = []
+
+        async def send_message(chat_id, text, **kwargs):
+            sent.append((chat_id, text))
+
+        monkeypatch.setattr(async_bot, "send_message", send_message)
+        handler = next(h for h in async_bot.message_handlers if "location" in h["filters"]["content_types"])
+        await handler["function"](location_message())
+        return sent
+
+    monkeypatch.setattr(forecast, "make_weather_request_async", unavailable)
+    assert asyncio.run(run()) == [(7, forecast.SERVICE_UNAVAILABLE_TEXT)]
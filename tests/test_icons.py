@@ -0,0 +1,45 @@
+import pytest
+import telebot
+from telebot import asyncio_helper
+
+
+def telegram_error(description, error_code=400, exception=telebot.apihelper.ApiTelegramException):
+    result = type("Result", (), {"status_code": error_code, "reason": "Bad Request", "text": ""})()
+    return exception("sendPhoto", result, {"error_code": error_code, "description": description})
+
+
+@pytest.mark.parametrize("description", [
+    "Bad Request: wrong file identifier/HTTP URL specified",
+    "Bad Request: wrong remote file identifier specified: Wrong padding in the string",
+    "Bad Request: wrong remote file id specified: can't unserialize it",
+])
+def test_wrong_file_id_allows_resend_by_url(forecast, description):
+    assert forecast.is_stale_file_id_error(telegram_error(description), cached=True)
+    assert forecast.is_stale_file_id_error(telegram_error(description, exception=asyncio_helper.ApiTelegramException), cached=True)
+    assert not forecast.is_stale_file_id_error(telegram_error(description), cached=False)
+
+
+@pytest.mark.parametrize("description, error_code", [
+    ("Bad Request: can't parse entities: Can't find end of the entity starting at byte offset 20", 400),
+    ("Bad Request: BUTTON_DATA_INVALID", 400),
+    ("Too Many Requests: retry after 5", 429),
+])
+def test_other_errors_keep_file_id(forecast, description, error_code):
+    assert not forecast.is_stale_file_id_error(telegram_error(description, error_code), cached=True)
+
+
+def test_send_weather_photo_keeps_file_id_on_markup_error(forecast, monkeypatch):
+    monkeypatch.setitem(forecast.weather_icons.file_ids, "01d", "cached-file-id")
+    sent = []
+
+    def send_photo(chat_id, photo, **kwargs):
+        sent.append(photo)
+        raise telegram_error("Bad Request: can't parse entities: Can't find end of the entity")
+
+    monkeypatch.setattr(forecast.bot, "send_photo", send_photo)
+
+    with pytest.raises(telebot.apihelper.ApiTelegramException):
+        forecast.send_weather_photo(1, "01d", "**Погода в a_b**")
+
+    assert sent == ["cached-file-id"]
+    assert forecast.weather_icons.file_ids["01d"] == "cached-file-id"
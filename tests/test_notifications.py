@@ -0,0 +1,65 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+NOW = datetime(2026, 1, 10, 0, 0, tzinfo=timezone.utc)
+TASHKENT = 5 * 3600
+
+
+@pytest.fixture
+def no_spread(forecast, monkeypatch):
+    monkeypatch.setattr(forecast, "NOTIFY_SPREAD_SECONDS", 0)
+
+
+def test_next_send_time_uses_city_local_hour(forecast, no_spread):
+    # 00:00 UTC = 05:00 в Ташкенте, до 08:00 местного ещё три часа
+    assert forecast.next_send_time(1, TASHKENT, NOW) == datetime(2026, 1, 10, 3, 0, tzinfo=timezone.utc)
+
+
+def test_next_send_time_rolls_over_to_next_day(forecast, no_spread):
+    now = datetime(2026, 1, 10, 4, 0, tzinfo=timezone.utc)  # 09:00 в Ташкенте
+    assert forecast.next_send_time(1, TASHKENT, now) == datetime(2026, 1, 11, 3, 0, tzinfo=timezone.utc)
+
+
+def test_next_send_time_negative_offset(forecast, no_spread):
+    # 00:00 UTC = 19:00 предыдущего дня в Нью-Йорке, следующие 08:00 — 13:00 UTC
+    assert forecast.next_send_time(1, -5 * 3600, NOW) == datetime(2026, 1, 10, 13, 0, tzinfo=timezone.utc)
+
+
+def test_next_send_time_spreads_users(forecast, monkeypatch):
+    monkeypatch.setattr(forecast, "NOTIFY_SPREAD_SECONDS", 3600)
+    base = datetime(2026, 1, 10, 3, 0, tzinfo=timezone.utc)
+    assert forecast.next_send_time(61, TASHKENT, NOW) == base + timedelta(seconds=61)
+    assert forecast.next_send_time(3601, TASHKENT, NOW) == base + timedelta(seconds=1)
+
+
+def reschedules(queries):
+    """ user_id -> next_send_at из RESCHEDULE_QUERY """
+    update = next(query for query in queries if "UPDATE weather_subscriptions" in query)
+    return {int(user_id): datetime.fromisoformat(value) for user_id, value in re.findall(r"\((\d+),'([^']+)'::timestamptz\)", update)}
+
+
+def test_send_due_notifications_grace_and_retry(forecast, pg, no_spread, monkeypatch):
+    pg.due_batches.append([(1, "Tashkent", True), (2, "Tashkent", False), (3, "Atlantis", True)])
+    weather = {"Tashkent": {"cod": 200, "timezone": TASHKENT, "main": {"temp": 20}, "weather": [{"description": "ясно", "icon": "01d"}]}}
+    monkeypatch.setattr(forecast, "make_weather_request", lambda endpoint, params: weather.get(params["q"]))
+    sent = []
+    monkeypatch.setattr(forecast, "send_weather_photo", lambda chat_id, *args: sent.append(chat_id))
+    monkeypatch.setattr(forecast.bot, "send_message", lambda chat_id, text, **kwargs: sent.append(chat_id))
+
+    started = datetime.now(timezone.utc)
+    forecast.send_due_notifications()
+
+    claim = next(query for query in pg.queries if "SKIP LOCKED" in query)
+    assert "3600" in claim  # окно NOTIFY_GRACE передано в запрос
+    # 2 просрочен дольше окна, Atlantis без погоды: им ничего не отправляется
+    assert sent == [1]
+
+    schedule = reschedules(pg.queries)
+    # И отправленный, и пропущенный переносятся на ближайшие 08:00 по Ташкенту
+    assert schedule[1] == schedule[2]
+    assert schedule[1].astimezone(timezone(timedelta(seconds=TASHKENT))).time().isoformat() == "08:00:00"
+    assert timedelta(0) < schedule[1] - started <= timedelta(days=1)
+    assert timedelta(minutes=14) < schedule[3] - started <= forecast.NOTIFY_RETRY_DELAY + timedelta(seconds=5)
+    assert pg.queries[-1] == "COMMIT"
@@ -0,0 +1,36 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Пользователь, о котором бот уже ответил, но строка ещё в очереди отложенной записи
+BOT_SCRIPT = """
+import forecast
+forecast.user_writer.put(4242, (4242, "user", "First", "Last", "ru", False))
+forecast.main()
+"""
+
+
+@pytest.mark.parametrize("mode", ["threaded", "async"])
+def test_sigterm_flushes_pending_writes(stubs, pg, mode):
+    env = {**os.environ, "BOT_MODE": mode, "WRITE_BEHIND_INTERVAL": "60", "PYTHONPATH": ROOT}
+    polls = stubs.calls["telegram.getUpdates"]
+    process = subprocess.Popen([sys.executable, "-c", BOT_SCRIPT], cwd=ROOT, env=env)
+    try:
+        deadline = time.monotonic() + 20
+        while stubs.calls["telegram.getUpdates"] == polls and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert stubs.calls["telegram.getUpdates"] > polls, "бот не начал опрос"
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+    assert any(query.lstrip().startswith("INSERT INTO telegram_users") and "4242" in query for query in pg.queries)
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from tests.stubs import start_http_stub
+
+
+@pytest.fixture
+def stalled_weather(forecast, monkeypatch):
+    """ OpenWeatherMap, который отвечает дольше таймаута чтения """
+    server, calls = start_http_stub(0.5)
+    monkeypatch.setattr(forecast, "WEATHER_URL", f"http://127.0.0.1:{server.server_port}/data/2.5/{{}}")
+    monkeypatch.setattr(forecast, "WEATHER_TIMEOUT", (1.0, 0.1))
+    monkeypatch.setattr(forecast, "weather_breaker", forecast.CircuitBreaker(5, 30))
+    monkeypatch.setattr(forecast, "aio_session", None)
+    yield calls
+    server.shutdown()
+    server.server_close()
+
+
+def test_read_timeout_is_not_retried(forecast, stalled_weather):
+    started = time.monotonic()
+    assert forecast.fetch_from_openweathermap("weather", {"q": "Tashkent"}) is None
+    assert time.monotonic() - started < 0.5
+    assert stalled_weather["owm.weather"] == 1
+
+
+def test_read_timeout_is_not_retried_async(forecast, stalled_weather):
+    async def fetch():
+        try:
+            return await forecast.fetch_from_openweathermap_async("weather", {"q": "Tashkent"})
+        finally:
+            await forecast.aio_session.close()
+
+    started = time.monotonic()
+    assert asyncio.run(fetch()) is None
+    assert time.monotonic() - started < 0.5
+    assert stalled_weather["owm.weather"] == 1
+
+
+class Response:
+    def __init__(self, retry_after):
+        self.headers = {"Retry-After": retry_after}
+
+
+def test_long_retry_after_is_ignored(forecast):
+    retry = forecast.WeatherRetry(total=3)
+    assert retry.get_retry_after(Response("2")) == 2
+    assert retry.get_retry_after(Response("3600")) is None
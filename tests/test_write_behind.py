@@ -0,0 +1,71 @@
+import time
+
+import psycopg2
+import pytest
+
+
+@pytest.fixture
+def make_queue(forecast):
+    """ WriteBehindQueue с заданной функцией записи; закрывается после теста """
+    queues = []
+
+    def make(flush_batch, batch_size=5, interval=0.05, max_retry_seconds=60):
+        queue = forecast.WriteBehindQueue("test", flush_batch, batch_size, interval, max_retry_seconds)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+
+def database_down(calls):
+    def flush_batch(batch):
+        calls.append(time.monotonic())
+        raise psycopg2.OperationalError("connection refused")
+    return flush_batch
+
+
+def test_failed_full_batch_is_retried_with_backoff(make_queue):
+    calls = []
+    queue = make_queue(database_down(calls), batch_size=5, interval=0.05)
+    for key in range(5):
+        queue.put(key, key)
+    time.sleep(0.5)
+
+    # Паузы 0.05, 0.1, 0.2... а не повтор в цикле без ожидания
+    assert 2 <= len(calls) <= 5
+    gaps = [later - earlier for earlier, later in zip(calls, calls[1:])]
+    assert all(gap >= 0.045 for gap in gaps)
+    assert gaps == sorted(gaps)
+    assert len(queue.pending) == 5
+
+
+def test_rows_are_dropped_after_max_retry_seconds(make_queue):
+    calls = []
+    queue = make_queue(database_down(calls), batch_size=5, interval=0.05, max_retry_seconds=0.3)
+    for key in range(5):
+        queue.put(key, key)
+
+    time.sleep(0.15)
+    assert len(queue.pending) == 5
+    time.sleep(0.6)
+    assert queue.pending == {}
+    assert queue.failing_since == {}
+
+
+def test_bad_row_is_dropped_and_the_rest_written(make_queue):
+    written = []
+
+    def flush_batch(batch):
+        if "bad" in batch:
+            raise psycopg2.DataError("value too long")
+        written.extend(batch)
+
+    queue = make_queue(flush_batch, batch_size=100)
+    for key in ("a", "bad", "b"):
+        queue.put(key, key)
+
+    assert queue.flush() is True
+    assert sorted(written) == ["a", "b"]
+    assert queue.pending == {}